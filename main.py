@@ -2,19 +2,30 @@ import os
 import asyncio
 import json
 import math
+import multiprocessing
 import statistics as stats
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import redirect_stdout
+from functools import lru_cache
 from io import StringIO
+from types import CodeType
 from typing import Any
+import numpy as np
 from anthropic import AsyncAnthropic
 from anthropic.types import MessageParam
 
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 MAX_TOKENS = 3200
+MAX_CONCURRENT_AGENTS = 5
+# Grading workers start after httpx has resolver threads running, so avoid fork(); forkserver is POSIX-only.
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
 
 BUGGY_PIPELINE = '''
-import math, statistics as stats
+import math
 
 def process_batch(events, state):
     if state is None:
@@ -23,8 +34,13 @@ def process_batch(events, state):
     state.setdefault("limit", 500)
     state.setdefault("buffer", [])
     readings = [float(e["reading"]) for e in events]
-    mean = sum(readings) / len(readings)
-    std = stats.pstdev(readings)
+    n, mean, m2 = 0, 0.0, 0.0
+    for x in readings:
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+    std = math.sqrt(m2 / n)
     scores = [(x - mean) / std for x in readings]
     clean = [ev for ev, score in zip(events, scores) if abs(score) < state.get("z_cutoff", 3)]
     state["seen"] += len(events)
@@ -33,12 +49,16 @@ def process_batch(events, state):
     return {"clean": clean, "mean": mean, "std": std, "alerts": [], "state": state}
 '''
 
+@lru_cache(maxsize=64)
+def _compile_expression(expression: str) -> CodeType:
+    return compile(expression, "<tool>", "exec")
+
 def python_tool(expression: str) -> dict:
     try:
-        ns = {"math": math, "stats": stats}
+        ns = {"math": math, "stats": stats, "np": np}
         out = StringIO()
         with redirect_stdout(out):
-            exec(expression, ns, ns)
+            exec(_compile_expression(expression), ns, ns)
         return {"result": out.getvalue() or "Executed", "error": None}
     except Exception as exc:
         return {"result": None, "error": str(exc)}
@@ -46,18 +66,45 @@ def python_tool(expression: str) -> dict:
 def submit_tool(code: str) -> dict:
     return {"code": code, "submitted": True}
 
+_TIER1 = (
+    {"ts": 3, "reading": " NaN", "tag": "sensor"},
+    {"ts": 2, "reading": "5.4", "tag": "healthy"},
+    {"ts": 1, "reading": None, "tag": "sensor"},
+    {"ts": 5, "reading": "bad", "tag": "sensor"},
+    {"ts": 4, "reading": "7.2", "tag": "healthy"},
+)
+_FLAT = tuple({"ts": i, "reading": 9.0, "tag": "core"} for i in range(6))
+_HEAVY = (
+    tuple({"ts": i, "reading": 10.0 + 0.1 * i, "tag": "core"} for i in range(6))
+    + tuple({"ts": 100 + i, "reading": 1000.0, "tag": "spike"} for i in range(2))
+    + tuple({"ts": 200 + i, "reading": 9.5, "tag": "minority"} for i in range(2))
+)
+_FLOOD = tuple({"ts": i, "reading": float(i % 7), "tag": "stream"} for i in range(60))
+_SANITY = tuple({"ts": i, "reading": float(i), "tag": "test"} for i in range(5))
+_HOT_BUFFER = tuple({"ts": -k} for k in range(150))
+
+def _events(fixture: tuple) -> list[dict]:
+    # Fixtures are shared across grades and never handed out directly; submissions may coerce or sort in place.
+    return [ev.copy() for ev in fixture]
+
 def _fresh_state() -> dict:
     return {"seen": 0, "limit": 200, "buffer": deque(maxlen=240), "z_cutoff": 3}
 
+def _hot_state() -> dict:
+    return {"seen": 190, "limit": 200, "buffer": deque(_events(_HOT_BUFFER), maxlen=260), "z_cutoff": 3}
+
 def _no_nan(value: Any) -> bool:
-    if isinstance(value, float) and math.isnan(value):
-        return False
-    return True
+    # NaN is the only float that compares unequal to itself.
+    return not isinstance(value, float) or value == value
+
+def _uniq(items: list[str]) -> list[str]:
+    seen: set[str] = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
 
 def grade(code: str) -> dict[str, Any]:
     try:
-        ns = {"math": math, "stats": stats}
-        exec(code, ns)
+        ns = {"math": math, "stats": stats, "np": np}
+        exec(compile(code, "<submission>", "exec"), ns)
         fn = ns.get("process_batch")
         if not callable(fn):
             return {"passed": False, "score": 0.0, "feedback": "process_batch missing"}
@@ -66,14 +113,7 @@ def grade(code: str) -> dict[str, Any]:
 
         # Tier 1: data integrity
         try:
-            tier1 = [
-                {"ts": 3, "reading": " NaN", "tag": "sensor"},
-                {"ts": 2, "reading": "5.4", "tag": "healthy"},
-                {"ts": 1, "reading": None, "tag": "sensor"},
-                {"ts": 5, "reading": "bad", "tag": "sensor"},
-                {"ts": 4, "reading": "7.2", "tag": "healthy"},
-            ]
-            res1 = fn(tier1, _fresh_state())
+            res1 = fn(_events(_TIER1), _fresh_state())
             clean = res1.get("clean", [])
             ok = isinstance(clean, (list, tuple)) and len(clean) >= 2
             if ok:
@@ -90,23 +130,17 @@ def grade(code: str) -> dict[str, Any]:
         # Tier 2: statistical stability
         ok2 = True
         try:
-            flat = [{"ts": i, "reading": 9.0, "tag": "core"} for i in range(6)]
-            res_flat = fn(flat, _fresh_state())
+            res_flat = fn(_events(_FLAT), _fresh_state())
             std = res_flat.get("std")
             clean_flat = res_flat.get("clean", [])
             ok2 &= isinstance(clean_flat, list)
-            ok2 &= len(clean_flat) >= len(flat) - 1
+            ok2 &= len(clean_flat) >= len(_FLAT) - 1
             ok2 &= isinstance(std, (int, float)) and not math.isnan(std) and std >= 0
         except Exception as exc:
             ok2 = False
             issues.append(f"Tier2 flat crash: {str(exc)[:40]}")
         try:
-            heavy = (
-                [{"ts": i, "reading": 10.0 + 0.1 * i, "tag": "core"} for i in range(6)]
-                + [{"ts": 100 + i, "reading": 1000.0, "tag": "spike"} for i in range(2)]
-                + [{"ts": 200 + i, "reading": 9.5, "tag": "minority"} for i in range(2)]
-            )
-            res_heavy = fn(heavy, _fresh_state())
+            res_heavy = fn(_events(_HEAVY), _fresh_state())
             clean_heavy = res_heavy.get("clean", [])
             ok2 &= isinstance(clean_heavy, list) and len(clean_heavy) >= 4
             upper = [ev.get("reading", 0) for ev in clean_heavy if isinstance(ev, dict)]
@@ -122,19 +156,11 @@ def grade(code: str) -> dict[str, Any]:
 
         # Tier 3: resilience and state stability
         try:
-            flood = [{"ts": i, "reading": float(i % 7), "tag": "stream"} for i in range(60)]
-            hot_state = {"seen": 190, "limit": 200, "buffer": deque(({"ts": -k} for k in range(150)), maxlen=260), "z_cutoff": 3}
-            res3 = fn(flood, hot_state)
+            res3 = fn(_events(_FLOOD), _hot_state())
             buf = res3.get("state", {}).get("buffer", [])
             telemetry = res3.get("telemetry", {})
-            if isinstance(buf, deque):
-                ok3 = len(buf) <= 240
-            else:
-                ok3 = isinstance(buf, list) and len(buf) <= 240
-            if isinstance(telemetry, dict):
-                ok3 &= True
-            else:
-                ok3 &= telemetry in (True,)
+            ok3 = isinstance(buf, (deque, list)) and len(buf) <= 240
+            ok3 &= isinstance(telemetry, dict) or telemetry in (True,)
         except Exception as exc:
             ok3 = False
             issues.append(f"Tier3 crash: {str(exc)[:40]}")
@@ -145,8 +171,7 @@ def grade(code: str) -> dict[str, Any]:
         # Output validity
         validity = True
         try:
-            sanity = [{"ts": i, "reading": float(i), "tag": "test"} for i in range(5)]
-            res = fn(sanity, _fresh_state())
+            res = fn(_events(_SANITY), _fresh_state())
             for val in (res.get("mean"), res.get("std")):
                 validity &= isinstance(val, (int, float)) and _no_nan(val)
             for row in res.get("clean", []):
@@ -168,27 +193,29 @@ def grade(code: str) -> dict[str, Any]:
 
         score = sum(checks.values()) / len(checks)
         passed = all(checks.values())
-        feedback = "✓ All tiers stable" if passed else "✗ " + "; ".join(dict.fromkeys(issues))
+        feedback = "✓ All tiers stable" if passed else "✗ " + "; ".join(_uniq(issues))
         return {"passed": passed, "score": score, "feedback": feedback, "details": checks}
     except Exception as exc:
         return {"passed": False, "score": 0.0, "feedback": f"Harness error: {str(exc)[:80]}"}
 
-async def run_agent(prompt: str, tools: list, handlers: dict, max_steps: int = 18) -> str | None:
-    client = AsyncAnthropic()
+async def run_agent(prompt: str, tools: list, handlers: dict, client: AsyncAnthropic, max_steps: int = 18) -> str | None:
     messages: list[MessageParam] = [{"role": "user", "content": prompt}]
     submitted = None
     for _ in range(max_steps):
-        response = await client.messages.create(
+        tool_calls = []
+        used_tool = False
+        async with client.messages.stream(
             model="claude-sonnet-4-20250514",
             max_tokens=MAX_TOKENS,
             tools=tools,
             messages=messages,
-        )
-        tool_calls = []
-        used_tool = False
-        for part in response.content:
-            if part.type == "tool_use":
+        ) as stream:
+            # Run each tool as soon as its input is complete, while later blocks are still streaming.
+            async for event in stream:
+                if event.type != "content_block_stop" or event.content_block.type != "tool_use":
+                    continue
                 used_tool = True
+                part = event.content_block
                 name = part.name
                 payload = part.input
                 handler = handlers.get(name)
@@ -199,22 +226,43 @@ async def run_agent(prompt: str, tools: list, handlers: dict, max_steps: int = 1
                         result = handler(payload.get("code", ""))
                         if name == "submit_code":
                             submitted = result.get("code")
+                            if submitted:
+                                return submitted
                     tool_calls.append({"type": "tool_result", "tool_use_id": part.id, "content": json.dumps(result)})
-        if used_tool:
-            messages.append({"role": "assistant", "content": response.content})
-            messages.append({"role": "user", "content": tool_calls})
-            if submitted:
-                return submitted
-        else:
+            response = await stream.get_final_message()
+        if not used_tool:
             break
+        messages.append({"role": "assistant", "content": response.content})
+        messages.append({"role": "user", "content": tool_calls})
     return submitted
 
-async def run_evaluation(run_id: int, prompt: str, tools: list, handlers: dict) -> tuple[int, bool, float]:
-    submission = await run_agent(prompt, tools, handlers)
+async def _grade_alone(submission: str) -> dict[str, Any]:
+    # A submission that kills its worker breaks the shared pool for everyone; regrade in a private one.
+    with ProcessPoolExecutor(max_workers=1, mp_context=_MP_CONTEXT) as solo:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(solo, grade, submission)
+        except BrokenProcessPool:
+            return {"passed": False, "score": 0.0, "feedback": "Harness error: grader process died"}
+
+async def run_evaluation(
+    run_id: int,
+    prompt: str,
+    tools: list,
+    handlers: dict,
+    client: AsyncAnthropic,
+    sem: asyncio.Semaphore,
+    pool: ProcessPoolExecutor,
+) -> tuple[int, bool, float]:
+    async with sem:
+        submission = await run_agent(prompt, tools, handlers, client)
     if not submission:
         print(f"❌ Run {run_id}: no submission")
         return run_id, False, 0.0
-    result = grade(submission)
+    # Grade off the event loop so submitted code never stalls other runs' API calls.
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(pool, grade, submission)
+    except BrokenProcessPool:
+        result = await _grade_alone(submission)
     status = "✅" if result["passed"] else "❌"
     print(f"{status} Run {run_id}: {result['score']:.0%} - {result['feedback'][:90]}")
     return run_id, result["passed"], result["score"]
@@ -241,7 +289,7 @@ async def main(concurrent: bool = True, num_runs: int = 10):
     tools = [
         {
             "name": "python_expression",
-            "description": "Execute Python (math, stats available).",
+            "description": "Execute Python (math, stats, np available).",
             "input_schema": {
                 "type": "object",
                 "properties": {"expression": {"type": "string"}},
@@ -264,11 +312,25 @@ async def main(concurrent: bool = True, num_runs: int = 10):
     print("🛡️  RESILIENCE GAUNTLET — CASCADING BUG HUNT")
     print("=" * 78)
     print(f"Running {num_runs} evaluations...\n")
-    tasks = [run_evaluation(i + 1, prompt, tools, handlers) for i in range(num_runs)]
-    if concurrent:
-        results = [await t for t in asyncio.as_completed(tasks)]
-    else:
-        results = [await t for t in tasks]
+    sem = asyncio.Semaphore(MAX_CONCURRENT_AGENTS)
+    with ProcessPoolExecutor(mp_context=_MP_CONTEXT) as pool:
+        async with AsyncAnthropic() as client:
+            tasks = [run_evaluation(i + 1, prompt, tools, handlers, client, sem, pool) for i in range(num_runs)]
+            if concurrent:
+                outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+            else:
+                outcomes = []
+                for t in tasks:
+                    try:
+                        outcomes.append(await t)
+                    except Exception as exc:
+                        outcomes.append(exc)
+    results = []
+    for run_id, outcome in enumerate(outcomes, start=1):
+        if isinstance(outcome, BaseException):
+            print(f"❌ Run {run_id}: error - {str(outcome)[:80]}")
+            outcome = (run_id, False, 0.0)
+        results.append(outcome)
     passes = sum(passed for _, passed, _ in results)
     avg = sum(score for _, _, score in results) / num_runs
     rate = (passes / num_runs) * 100